@@ -1,11 +1,18 @@
-from pymongo import MongoClient
+from pymongo import AsyncMongoClient
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
 # connect to mongo atlas cluster
-mongo_client = MongoClient(os.getenv("MONGO_URI"))
+mongo_client = AsyncMongoClient(
+    os.getenv("MONGO_URI"),
+    maxPoolSize=50,
+    minPoolSize=10,
+    serverSelectionTimeoutMS=5000,
+    socketTimeoutMS=10000,
+    retryWrites=True,
+)
 
 
 # Access database
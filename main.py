@@ -1,27 +1,53 @@
 # main.py
-import requests
+import asyncio
+import httpx
+import logging
 import os
+from contextlib import asynccontextmanager
 from datetime import datetime
-from typing import Optional, Annotated
+from typing import Dict, List, Optional, Annotated
 from bson import ObjectId
-from fastapi import FastAPI, HTTPException, Query, Form, status, File, UploadFile
+from cachetools import TTLCache
+from fastapi import FastAPI, Depends, HTTPException, Query, Form, status, File, UploadFile
+from fastapi.middleware.gzip import GZipMiddleware
 from pydantic import BaseModel, Field, HttpUrl
+from pymongo import DESCENDING
+from pymongo.errors import DuplicateKeyError
 from dotenv import load_dotenv
 
 # --- Cloudinary and Database Integration ---
 import cloudinary
 import cloudinary.uploader
-from db import favourites_collection
+import cloudinary.utils
+from db import favourites_collection, mongo_client
 from utils import replace_mongo_id
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # --- Configure Cloudinary ---
 cloudinary.config(
     cloud_name=os.getenv("CLOUD_NAME"),
     api_key=os.getenv("API_KEY"),
     api_secret=os.getenv("API_SECRET"),
 )
+# The uploader keeps one urllib3 pool for its lifetime, but it only holds a
+# single idle connection per host. Uploads run via asyncio.to_thread, so size
+# the pool like the default executor (ThreadPoolExecutor's own formula) to keep
+# a connection alive for each concurrent upload. This relies on the SDK's
+# private module-level `_http`; warn if an upgrade removes it.
+CLOUDINARY_POOL_SIZE = min(32, (os.cpu_count() or 1) + 4)
+if hasattr(cloudinary.uploader, "_http"):
+    cloudinary.uploader._http = cloudinary.utils.get_http_connector(
+        cloudinary.config(),
+        {**cloudinary.CERT_KWARGS, "maxsize": CLOUDINARY_POOL_SIZE},
+    )
+else:
+    logger.warning(
+        "cloudinary.uploader._http not found; Cloudinary connection pool "
+        "keeps its default size."
+    )
 
 # --- FastAPI App Initialization with OpenAPI Tags ---
 tags_metadata = [
@@ -39,11 +65,47 @@ tags_metadata = [
     },
 ]
 
+async def ensure_name_index():
+    # A plain name index left by an earlier start blocks the unique one with
+    # the same key, so drop it and retry now that duplicates may be gone
+    name_index = (await favourites_collection.index_information()).get("name_1")
+    if name_index and not name_index.get("unique"):
+        await favourites_collection.drop_index("name_1")
+    try:
+        await favourites_collection.create_index("name", unique=True)
+    except DuplicateKeyError:
+        # Older data can hold the same country twice; keep serving and let
+        # the operator clean it up (see README) so the index can be built.
+        # A plain index keeps the duplicate pre-check in the save path fast.
+        await favourites_collection.create_index("name")
+        logger.warning(
+            "Could not create the unique index on favourites.name because "
+            "duplicate names exist; concurrent duplicates are not prevented."
+        )
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One shared HTTP client so connections to REST Countries are reused
+    app.state.http = httpx.AsyncClient(
+        base_url="https://restcountries.com/v3.1",
+        timeout=5.0,
+        limits=httpx.Limits(max_keepalive_connections=50, max_connections=100),
+    )
+    await ensure_name_index()
+    await favourites_collection.create_index([("date_saved", DESCENDING)])
+    # Build the OpenAPI schema now so the first /docs visit doesn't pay for it
+    app.openapi()
+    yield
+    await app.state.http.aclose()
+    await mongo_client.close()
+
 app = FastAPI(
     title="Queen's Country Explorer API",
     description="Fetch data about countries, save your favorites with notes, and compare them.",
     openapi_tags=tags_metadata,
+    lifespan=lifespan,
 )
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
 
 # --- Pydantic Models ---
 class CountryData(BaseModel):
@@ -55,19 +117,27 @@ class CountryData(BaseModel):
 
 class SavedCountry(BaseModel):
     """Represents a country saved as a favorite in the database."""
-    id: Optional[str] = Field(alias="_id", default=None)
+    id: Optional[str] = None
     name: str
     capital: Optional[str] = None
     population: int
     region: str
     user_notes: Optional[str] = None
-    image_url: Optional[HttpUrl] = None  
-    image_public_id: Optional[str] = None  
+    image_url: Optional[HttpUrl] = None
+    image_public_id: Optional[str] = None
     date_saved: datetime = Field(default_factory=datetime.utcnow)
 
-    class Config:
-        populate_by_name = True
-        json_encoders = {ObjectId: str}
+class FavoriteResponse(BaseModel):
+    """Model for endpoints that return a single favorite country."""
+    data: SavedCountry
+
+class FavoriteListResponse(BaseModel):
+    """Model for the favorite countries listing."""
+    data: List[SavedCountry]
+
+class MessageResponse(BaseModel):
+    """Model for endpoints that only return a status message."""
+    message: str
 
 class ComparisonResult(BaseModel):
     """Model for the country comparison response."""
@@ -76,11 +146,17 @@ class ComparisonResult(BaseModel):
     population_difference: int
     message: str
 
-# --- Helper Function ---
-def fetch_country_from_api(name: str) -> Optional[CountryData]:
-    url = f"https://restcountries.com/v3.1/name/{name}?fullText=true"
+# --- Helper Functions ---
+# Country facts rarely change, so successful lookups are kept for an hour
+country_cache = TTLCache(maxsize=1024, ttl=3600)
+inflight_requests: Dict[str, asyncio.Task] = {}
+
+async def request_country(name: str) -> Optional[CountryData]:
     try:
-        response = requests.get(url)
+        response = await app.state.http.get(
+            f"/name/{name}",
+            params={"fullText": "true", "fields": "name,capital,population,region"},
+        )
         response.raise_for_status()
         data = response.json()[0]
         capital = data.get("capital", [None])[0]
@@ -90,13 +166,63 @@ def fetch_country_from_api(name: str) -> Optional[CountryData]:
             population=data["population"],
             region=data["region"],
         )
-    except (requests.exceptions.RequestException, IndexError, KeyError):
+    except (httpx.HTTPError, ValueError, IndexError, KeyError):
         return None
 
+async def load_country(name: str, key: str) -> Optional[CountryData]:
+    try:
+        country_data = await request_country(name)
+        if country_data:
+            country_cache[key] = country_data
+        return country_data
+    finally:
+        inflight_requests.pop(key, None)
+
+async def fetch_country_from_api(name: str) -> Optional[CountryData]:
+    key = name.lower()
+    country_data = country_cache.get(key)
+    if country_data is not None:
+        return country_data
+    # Concurrent lookups for the same country share one upstream request
+    task = inflight_requests.get(key)
+    if task is None:
+        task = asyncio.create_task(load_country(name, key))
+        inflight_requests[key] = task
+    return await asyncio.shield(task)
+
+async def upload_image(picture: UploadFile) -> dict:
+    # Stream the file to Cloudinary in chunks, off the event loop
+    # upload_large defaults to resource_type="raw"; keep favourites as images
+    # so their URLs and destroy() (which defaults to "image") line up
+    return await asyncio.to_thread(
+        cloudinary.uploader.upload_large,
+        picture.file,
+        chunk_size=6_000_000,
+        resource_type="image",
+    )
+
+async def destroy_image(public_id: str) -> dict:
+    return await asyncio.to_thread(cloudinary.uploader.destroy, public_id)
+
+async def discard_image(public_id: str) -> None:
+    # Best-effort cleanup once the database change is committed; a failure
+    # only leaves an orphaned upload, so log it instead of failing the request
+    try:
+        await destroy_image(public_id)
+    except Exception:
+        logger.exception("Failed to delete Cloudinary image %s", public_id)
+
+def valid_favorite_id(favorite_id: str) -> ObjectId:
+    if not ObjectId.is_valid(favorite_id):
+        raise HTTPException(
+            status.HTTP_422_UNPROCESSABLE_ENTITY, "Invalid favorite ID received!"
+        )
+    return ObjectId(favorite_id)
+
 # --- API Endpoints ---
 
 # --- Home Endpoint ---
-@app.get("/", tags=["Home"], summary="Welcome Message")
+@app.get("/", response_model=MessageResponse, tags=["Home"], summary="Welcome Message")
 def read_root():
     return {"message": "Welcome to the Queen's Country Explorer API!"}
 
@@ -107,8 +233,8 @@ def read_root():
     tags=["Country Information"],
     summary="Search for a single country",
 )
-def search_country_info(name: str):
-    country_data = fetch_country_from_api(name)
+async def search_country_info(name: str):
+    country_data = await fetch_country_from_api(name)
     if not country_data:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -122,17 +248,18 @@ def search_country_info(name: str):
     tags=["Country Information"],
     summary="Compare two countries by population",
 )
-def compare_countries(
+async def compare_countries(
     country1: str = Query(..., description="The first country to compare. Example: China"),
     country2: str = Query(..., description="The second country to compare. Example: India"),
 ):
-    data1 = fetch_country_from_api(country1)
+    data1, data2 = await asyncio.gather(
+        fetch_country_from_api(country1), fetch_country_from_api(country2)
+    )
     if not data1:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Country '{country1}' not found.",
         )
-    data2 = fetch_country_from_api(country2)
     if not data2:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -155,138 +282,155 @@ def compare_countries(
 # --- Favorite Countries Endpoints ---
 @app.post(
     "/favorites",
+    response_model=FavoriteResponse,
     status_code=status.HTTP_201_CREATED,
     tags=["Favorite Countries"],
     summary="Save a country as a favorite with an image",
 )
-def save_favorite_country(
+async def save_favorite_country(
     name: Annotated[str, Form()],
     user_notes: Annotated[Optional[str], Form()] = None,
     favorite_picture: Annotated[Optional[UploadFile], File()] = None,
 ):
-    if favourites_collection.find_one({"name": name}):
-        raise HTTPException(
-            status_code=status.HTTP_409_CONFLICT,
-            detail=f"'{name}' is already in your favorites.",
-        )
-    country_data = fetch_country_from_api(name)
+    country_data = await fetch_country_from_api(name)
     if not country_data:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Cannot save favorite: Country '{name}' not found.",
         )
+    # Cheap index-backed check so duplicates skip the image upload; the unique
+    # index still settles races at insert time
+    if await favourites_collection.find_one(
+        {"name": country_data.name}, projection={"_id": 1}
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"'{name}' is already in your favorites.",
+        )
 
     image_url = None
     image_public_id = None
     if favorite_picture:
-        upload_result = cloudinary.uploader.upload(favorite_picture.file)
+        upload_result = await upload_image(favorite_picture)
         image_url = upload_result["secure_url"]
         image_public_id = upload_result["public_id"]
 
-    favorite_doc = SavedCountry(
+    doc_to_insert = {
         **country_data.model_dump(),
-        user_notes=user_notes,
-        image_url=image_url,
-        image_public_id=image_public_id,
-    )
-    
-    doc_to_insert = favorite_doc.model_dump(mode='json', by_alias=True, exclude={"id"})
+        "user_notes": user_notes,
+        "image_url": image_url,
+        "image_public_id": image_public_id,
+        "date_saved": datetime.utcnow(),
+    }
 
-    db_result = favourites_collection.insert_one(doc_to_insert)
-    created_favorite = favourites_collection.find_one({"_id": db_result.inserted_id})
-    return {"data": replace_mongo_id(created_favorite)}
+    try:
+        db_result = await favourites_collection.insert_one(doc_to_insert)
+    except Exception as error:
+        if image_public_id:
+            await discard_image(image_public_id)
+        if isinstance(error, DuplicateKeyError):
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f"'{name}' is already in your favorites.",
+            )
+        raise
+    doc_to_insert["_id"] = db_result.inserted_id
+    return {"data": replace_mongo_id(doc_to_insert)}
 
 @app.get(
     "/favorites",
+    response_model=FavoriteListResponse,
     tags=["Favorite Countries"],
     summary="List all favorite countries"
 )
-def get_all_favorites(limit: int = 10, skip: int = 0):
-    favorites_cursor = (
-        favourites_collection.find().sort("date_saved", -1).limit(limit).skip(skip)
-    )
-    favorites_list = list(favorites_cursor)
-    return {"data": list(map(replace_mongo_id, favorites_list))}
+async def get_all_favorites(
+    limit: int = Query(10, ge=0, description="Maximum favorites to return; 0 returns all."),
+    skip: int = Query(0, ge=0, description="Number of favorites to skip."),
+):
+    # Let Mongo turn _id into a string id so no per-document fix-up is needed
+    pipeline = [{"$sort": {"date_saved": -1}}, {"$skip": skip}]
+    if limit:
+        pipeline.append({"$limit": limit})
+    pipeline += [
+        {"$addFields": {"id": {"$toString": "$_id"}}},
+        {"$project": {"_id": 0}},
+    ]
+    favorites_cursor = await favourites_collection.aggregate(pipeline)
+    favorites_list = await favorites_cursor.to_list(length=limit or None)
+    return {"data": favorites_list}
 
 @app.get(
     "/favorites/{favorite_id}",
+    response_model=FavoriteResponse,
     tags=["Favorite Countries"],
     summary="Get a specific favorite country",
 )
-def get_favorite_by_id(favorite_id: str):
-    if not ObjectId.is_valid(favorite_id):
-        raise HTTPException(
-            status.HTTP_422_UNPROCESSABLE_ENTITY, "Invalid favorite ID received!"
-        )
-    favorite = favourites_collection.find_one({"_id": ObjectId(favorite_id)})
+async def get_favorite_by_id(favorite_oid: Annotated[ObjectId, Depends(valid_favorite_id)]):
+    favorite = await favourites_collection.find_one({"_id": favorite_oid})
     if not favorite:
         raise HTTPException(status.HTTP_404_NOT_FOUND, "Favorite country not found.")
     return {"data": replace_mongo_id(favorite)}
 
 @app.put(
     "/favorites/{favorite_id}",
+    response_model=MessageResponse,
     tags=["Favorite Countries"],
     summary="Update notes and/or image for a favorite country",
 )
-def update_favorite_country(
-    favorite_id: str,
+async def update_favorite_country(
+    favorite_oid: Annotated[ObjectId, Depends(valid_favorite_id)],
     user_notes: Annotated[Optional[str], Form()] = None,
     favorite_picture: Annotated[Optional[UploadFile], File()] = None,
 ):
-    if not ObjectId.is_valid(favorite_id):
-        raise HTTPException(
-            status.HTTP_422_UNPROCESSABLE_ENTITY, "Invalid favorite ID received!"
-        )
-    existing_favorite = favourites_collection.find_one({"_id": ObjectId(favorite_id)})
+    existing_favorite = await favourites_collection.find_one(
+        {"_id": favorite_oid}, projection={"image_public_id": 1}
+    )
     if not existing_favorite:
         raise HTTPException(
             status.HTTP_404_NOT_FOUND, "No favorite country found to update!"
         )
     
+    if user_notes is None and not favorite_picture:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, "No update fields provided.")
+    
     update_fields = {}
     if user_notes is not None:
         update_fields["user_notes"] = user_notes
     
     if favorite_picture:
-        if existing_favorite.get("image_public_id"):
-            cloudinary.uploader.destroy(existing_favorite["image_public_id"])
-        
-        upload_result = cloudinary.uploader.upload(favorite_picture.file)
+        upload_result = await upload_image(favorite_picture)
         update_fields["image_url"] = upload_result["secure_url"]
         update_fields["image_public_id"] = upload_result["public_id"]
-        
-    if not update_fields:
-        raise HTTPException(status.HTTP_400_BAD_REQUEST, "No update fields provided.")
     
-    favourites_collection.update_one(
-        {"_id": ObjectId(favorite_id)}, {"$set": update_fields}
-    )
+    try:
+        await favourites_collection.update_one(
+            {"_id": favorite_oid}, {"$set": update_fields}
+        )
+    except Exception:
+        if favorite_picture:
+            await discard_image(update_fields["image_public_id"])
+        raise
+    
+    # Only drop the old image once the document points at the new one
+    if favorite_picture and existing_favorite.get("image_public_id"):
+        await discard_image(existing_favorite["image_public_id"])
     return {"message": "Favorite country updated successfully!"}
 
 @app.delete(
     "/favorites/{favorite_id}",
+    response_model=MessageResponse,
     tags=["Favorite Countries"],
     summary="Delete a favorite country",
 )
-def delete_favorite(favorite_id: str):
-    if not ObjectId.is_valid(favorite_id):
-        raise HTTPException(
-            status.HTTP_422_UNPROCESSABLE_ENTITY, "Invalid favorite ID received!"
-        )
-    
-    favorite_to_delete = favourites_collection.find_one({"_id": ObjectId(favorite_id)})
-    if not favorite_to_delete:
+async def delete_favorite(favorite_oid: Annotated[ObjectId, Depends(valid_favorite_id)]):
+    deleted_favorite = await favourites_collection.find_one_and_delete(
+        {"_id": favorite_oid}, projection={"image_public_id": 1}
+    )
+    if not deleted_favorite:
         raise HTTPException(
             status.HTTP_404_NOT_FOUND, "No favorite country found to delete!"
         )
     
-    if favorite_to_delete.get("image_public_id"):
-        cloudinary.uploader.destroy(favorite_to_delete["image_public_id"])
-    
-    delete_result = favourites_collection.delete_one({"_id": ObjectId(favorite_id)})
-    
-    if not delete_result.deleted_count:
-        raise HTTPException(
-            status.HTTP_404_NOT_FOUND, "No favorite country found to delete!"
-        )
+    if deleted_favorite.get("image_public_id"):
+        await discard_image(deleted_favorite["image_public_id"])
     return {"message": "Favorite country deleted successfully!"}